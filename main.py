@@ -1,20 +1,51 @@
-from fastapi import FastAPI, HTTPException, Form, Body, Query
+from fastapi import FastAPI, APIRouter, HTTPException, Form, Body, Query
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import FileResponse
+from fastapi.responses import FileResponse, JSONResponse
 from fastapi.staticfiles import StaticFiles
 from motor.motor_asyncio import AsyncIOMotorClient
-from pydantic import BaseModel
+from pymongo import IndexModel, UpdateOne
+from pymongo.errors import BulkWriteError
+from pydantic import BaseModel, Field, field_validator
 from dotenv import load_dotenv
 from datetime import datetime
-from typing import Optional, Dict, Any
+from typing import Annotated, Optional, Dict, Any
 from bson import ObjectId
+from argon2 import PasswordHasher
+from argon2.exceptions import VerifyMismatchError, InvalidHashError
 import os
-import pandas as pd
+import re
+import time
+import logging
+import asyncio
+import glob
+import hashlib
+import hmac
 import tempfile
+import xlsxwriter
+import orjson
 
 load_dotenv()
 
-app = FastAPI(title="Master Contact CRM API")
+# ================================
+# JSON Responses (orjson)
+# ================================
+def _json_default(value: Any) -> Any:
+    if isinstance(value, ObjectId):
+        return str(value)
+    raise TypeError
+
+class CRMJSONResponse(JSONResponse):
+    # orjson encodes in native code and handles datetime itself. Routes that
+    # return plain dicts still go through FastAPI's jsonable_encoder first;
+    # the large payloads (history, contact) return this class directly to skip it
+    def render(self, content: Any) -> bytes:
+        return orjson.dumps(content, default=_json_default)
+
+app = FastAPI(title="Master Contact CRM API", default_response_class=CRMJSONResponse)
+
+# All JSON/API routes live under /api so a reverse proxy can serve everything
+# else (the frontend) directly
+api = APIRouter(prefix="/api")
 
 # ================================
 # CORS (Allow your frontend)
@@ -35,11 +66,101 @@ MONGODB_URL = os.getenv("MONGODB_URL")
 if not MONGODB_URL:
     raise RuntimeError("MONGODB_URL not set in .env")
 
-client = AsyncIOMotorClient(MONGODB_URL)
+# One client per process; pool sized for expected concurrency
+client = AsyncIOMotorClient(
+    MONGODB_URL,
+    maxPoolSize=int(os.getenv("MONGO_MAX_POOL_SIZE", "50")),
+    minPoolSize=int(os.getenv("MONGO_MIN_POOL_SIZE", "10")),
+    serverSelectionTimeoutMS=3000,
+    connectTimeoutMS=3000,
+    socketTimeoutMS=15000
+)
 db = client[os.getenv("DB_NAME", "CRM")]
 contacts_collection = db["crm_data"]          # All contacts go here
 config_collection = db["config"]              # For login credentials (optional)
 
+# Write counter stored in MongoDB and bumped on every contact write, so cached
+# Excel exports are invalidated by edits from any app instance, across restarts
+DATA_VERSION_ID = "crm_data_version"
+
+contacts_logger = logging.getLogger("crm.contacts")
+
+# Internal fields never returned to clients or exported
+HIDDEN_FIELDS = {"search_tokens": 0, "phone_digits": 0}
+
+# Short-lived cache of filtered counts for /get_history: {version:query: (expires_at, total)}
+COUNT_CACHE_TTL = 30
+_count_cache: Dict[str, Any] = {}
+
+# ================================
+# Startup: Connection Warmup & Indexes
+# ================================
+@app.on_event("startup")
+async def warm_up_connection_pool():
+    # Establish the first connection now so no request pays for it
+    await client.admin.command("ping")
+
+@app.on_event("startup")
+async def create_indexes():
+    # Filter and sort fields used by /get_history
+    await contacts_collection.create_indexes([
+        IndexModel([("created_at", -1), ("_id", -1)]),   # keyset pagination
+        IndexModel([("disposition", 1), ("created_at", -1)]),
+        IndexModel([("call_date", -1)]),
+        IndexModel([("lead_entry_date", -1)]),
+        IndexModel([("company_name", 1)]),
+        IndexModel([("mobile", 1)]),
+        IndexModel([("mobile2", 1)]),
+        IndexModel([("email", 1)]),
+        IndexModel([("search_tokens", 1)]),
+        IndexModel([("phone_digits", 1)])
+    ])
+
+# Contacts saved before search_tokens/phone_digits existed only match the slow
+# fallback branches in /get_history until they are backfilled
+BACKFILL_BATCH_SIZE = 500
+_backfill_task: Optional[asyncio.Task] = None
+
+async def backfill_derived_fields():
+    # Idempotent: only touches documents still missing a derived field, so it
+    # is safe to run on every startup and from several instances at once
+    missing = {"$or": [
+        {"search_tokens": {"$exists": False}},
+        {"phone_digits": {"$exists": False}}
+    ]}
+    cursor = contacts_collection.find(
+        missing, {field: 1 for field in SEARCH_FIELDS + PHONE_FIELDS}
+    ).batch_size(BACKFILL_BATCH_SIZE)
+
+    ops, updated = [], 0
+    async for doc in cursor:
+        ops.append(UpdateOne({"_id": doc["_id"]}, {"$set": {
+            "search_tokens": build_search_tokens(doc),
+            "phone_digits": build_phone_digits(doc)
+        }}))
+        if len(ops) == BACKFILL_BATCH_SIZE:
+            await contacts_collection.bulk_write(ops, ordered=False)
+            updated += len(ops)
+            ops = []
+    if ops:
+        await contacts_collection.bulk_write(ops, ordered=False)
+        updated += len(ops)
+
+    if updated:
+        contacts_logger.info("Backfilled search fields on %d contacts", updated)
+
+async def run_backfill():
+    try:
+        await backfill_derived_fields()
+    except Exception as e:
+        contacts_logger.error("Search field backfill failed: %s", e)
+
+@app.on_event("startup")
+async def start_backfill():
+    # Runs in the background so startup is not held up on large collections
+    global _backfill_task
+    _backfill_task = asyncio.create_task(run_backfill())
+
 # ================================
 # Pydantic Models
 # ================================
@@ -47,6 +168,94 @@ class LoginRequest(BaseModel):
     email: str
     password: str
 
+class HistoryFilters(BaseModel):
+    page: int = Field(1, ge=1)
+    limit: int = Field(50, ge=1, le=200)
+    search: str = ""
+    company: str = ""
+    phone: str = ""
+    disposition: str = ""
+    call_start: Optional[datetime] = None
+    call_end: Optional[datetime] = None
+    lead_start: Optional[datetime] = None
+    lead_end: Optional[datetime] = None
+    start: Optional[datetime] = None
+    end: Optional[datetime] = None
+    after_created_at: Optional[datetime] = None
+    after_id: Optional[str] = None
+    legacy: bool = False
+    skip_count: bool = False
+
+    # The dashboard sends empty strings for unset filters
+    @field_validator(
+        "call_start", "call_end", "lead_start", "lead_end", "start", "end",
+        "after_created_at", "after_id", mode="before"
+    )
+    @classmethod
+    def blank_to_none(cls, value):
+        return None if value == "" else value
+
+    # "end" covers the whole day it names
+    @field_validator("end")
+    @classmethod
+    def end_of_day(cls, value):
+        if value is not None:
+            return datetime.combine(value.date(), datetime.max.time())
+        return value
+
+    @field_validator("after_id")
+    @classmethod
+    def valid_cursor_id(cls, value):
+        if value is not None and not ObjectId.is_valid(value):
+            raise ValueError("Invalid cursor")
+        return value
+
+async def mark_data_changed():
+    # Called after the contact write is acknowledged; a failure here only
+    # delays cache invalidation, so it is logged rather than failing the request
+    try:
+        await config_collection.update_one(
+            {"_id": DATA_VERSION_ID}, {"$inc": {"version": 1}}, upsert=True
+        )
+    except Exception as e:
+        contacts_logger.error("Error bumping data version: %s", e)
+
+async def get_data_version() -> int:
+    doc = await config_collection.find_one({"_id": DATA_VERSION_ID})
+    return doc.get("version", 0) if doc else 0
+
+# ================================
+# Search Helpers
+# ================================
+SEARCH_FIELDS = ["name", "company_name", "email", "mobile"]
+PHONE_FIELDS = ["mobile", "mobile2"]
+
+def trigrams(text: str) -> set:
+    text = text.lower()
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+def build_search_tokens(doc: Dict[str, Any]) -> list:
+    # Trigrams of the globally searchable fields, stored on each contact so
+    # /get_history can prefilter substring searches with an indexed lookup
+    tokens = set()
+    for field in SEARCH_FIELDS:
+        value = doc.get(field)
+        if isinstance(value, str):
+            tokens |= trigrams(value)
+    return list(tokens)
+
+def build_phone_digits(doc: Dict[str, Any]) -> list:
+    # Digits-only copies of the free-form phone fields, so the phone filter
+    # matches "98200-12345" and "+91 98200 12345" alike
+    digits = []
+    for field in PHONE_FIELDS:
+        value = doc.get(field)
+        if isinstance(value, str):
+            value_digits = re.sub(r"\D", "", value)
+            if value_digits:
+                digits.append(value_digits)
+    return digits
+
 # ================================
 # Routes
 # ================================
@@ -56,7 +265,89 @@ class LoginRequest(BaseModel):
 #     return {"message": "Master Contact CRM API - Running!"}
 
 # ------------------ Login ------------------
-@app.post("/login")
+logger = logging.getLogger("crm.auth")
+
+USERS_CACHE_TTL = 60
+_users_cache = {"exp": 0.0, "id": None, "emails": frozenset(), "hash": "", "pw": ""}
+
+# Successful logins: {hmac(email, password, hash): expires_at}. Lets repeat
+# logins skip argon2, which is deliberately slow. The key is process-local.
+VERIFIED_LOGIN_TTL = 300
+_verified_logins: Dict[str, float] = {}
+_login_cache_secret = os.urandom(32)
+
+password_hasher = PasswordHasher()
+
+async def get_login_config():
+    # The credential document rarely changes; serve it from memory for
+    # USERS_CACHE_TTL seconds instead of hitting MongoDB on every login
+    now = time.monotonic()
+    if now < _users_cache["exp"]:
+        return _users_cache
+
+    # Fetch user document from 'users' collection in CRM database
+    users_collection = db["users"]
+    user_doc = await users_collection.find_one({})
+
+    if not user_doc:
+        raise HTTPException(status_code=500, detail="User config not found")
+
+    # Get allowed emails and password hash from the document. A plaintext
+    # "password" is still accepted until the first successful login migrates it.
+    _users_cache["id"] = user_doc["_id"]
+    # Normalised once per fetch into a frozenset for O(1) membership tests;
+    # non-string entries are ignored rather than failing every login
+    _users_cache["emails"] = frozenset(
+        e.strip().lower() for e in user_doc.get("allowed_emails", []) if isinstance(e, str)
+    )
+    password_hash = user_doc.get("password_hash", "")
+    plain_password = user_doc.get("password", "")
+    if (password_hash, plain_password) != (_users_cache["hash"], _users_cache["pw"]):
+        # Credentials rotated: earlier verifications no longer count
+        _verified_logins.clear()
+    _users_cache["hash"] = password_hash
+    _users_cache["pw"] = plain_password
+    _users_cache["exp"] = now + USERS_CACHE_TTL
+    return _users_cache
+
+async def verify_password(email: str, password: str, config: Dict[str, Any]) -> bool:
+    # Plaintext password (legacy, or newly set by an admin): checked before the
+    # verification cache so a rotation takes effect at once; on a match it is
+    # replaced with an argon2 hash
+    if config["pw"]:
+        if not hmac.compare_digest(password.encode(), config["pw"].encode()):
+            return False
+        password_hash = await asyncio.to_thread(password_hasher.hash, password)
+        await db["users"].update_one(
+            {"_id": config["id"]},
+            {"$set": {"password_hash": password_hash}, "$unset": {"password": ""}}
+        )
+        config["hash"], config["pw"] = password_hash, ""
+        return True
+
+    if not config["hash"]:
+        return False
+
+    now = time.monotonic()
+    cache_key = hmac.new(
+        _login_cache_secret,
+        "\0".join([email, password, config["hash"]]).encode(),
+        hashlib.sha256
+    ).hexdigest()
+    if _verified_logins.get(cache_key, 0.0) > now:
+        return True
+
+    try:
+        await asyncio.to_thread(password_hasher.verify, config["hash"], password)
+    except (VerifyMismatchError, InvalidHashError):
+        return False
+
+    for stale in [k for k, exp in _verified_logins.items() if exp <= now]:
+        del _verified_logins[stale]
+    _verified_logins[cache_key] = now + VERIFIED_LOGIN_TTL
+    return True
+
+@api.post("/login")
 async def login(request: LoginRequest):
     email = request.email.strip().lower()
     password = request.password
@@ -65,24 +356,14 @@ async def login(request: LoginRequest):
         raise HTTPException(status_code=400, detail="Email and password required")
 
     try:
-        # Fetch user document from 'users' collection in CRM database
-        users_collection = db["users"]
-        user_doc = await users_collection.find_one({})
-        
-        if not user_doc:
-            raise HTTPException(status_code=500, detail="User config not found")
+        config = await get_login_config()
+        allowed_emails = config["emails"]
 
-        # Get allowed emails and password from the document
-        allowed_emails = [e.strip().lower() for e in user_doc.get("allowed_emails", [])]
-        db_password = user_doc.get("password", "")
-
-        print(f"DEBUG: Email entered: {email}")
-        print(f"DEBUG: Password entered: {password}")
-        print(f"DEBUG: Allowed emails: {allowed_emails}")
-        print(f"DEBUG: DB Password: {db_password}")
+        logger.debug("Email entered: %s", email)
+        logger.debug("Allowed emails: %s", allowed_emails)
 
         # Check if email is in allowed list and password matches
-        if email in allowed_emails and password == db_password:
+        if email in allowed_emails and await verify_password(email, password, config):
             username = email.split("@")[0].replace(".", " ").title()
             return {"status": "success", "message": "Login successful", "user": username}
         else:
@@ -91,10 +372,72 @@ async def login(request: LoginRequest):
     except HTTPException:
         raise
     except Exception as e:
-        print(f"Login error: {e}")
+        logger.error("Login error: %s", e)
         raise HTTPException(status_code=500, detail="Server error")
 # ------------------ Submit Contact ------------------
-@app.post("/submit")
+# Optional write batching for bursty submits (SUBMIT_BATCHING=true): inserts
+# are queued and flushed every SUBMIT_FLUSH_INTERVAL seconds, or as soon as
+# SUBMIT_BATCH_MAX are pending, with one unordered bulk_write. Each request
+# still waits for its own write to be acknowledged before responding.
+SUBMIT_BATCHING = os.getenv("SUBMIT_BATCHING", "false").lower() == "true"
+SUBMIT_FLUSH_INTERVAL = 0.1
+SUBMIT_BATCH_MAX = 50
+
+_pending_submits: list = []          # [(UpdateOne, Future)]
+_submit_flush_lock = asyncio.Lock()
+_submit_batch_full = asyncio.Event()
+_submit_flush_task: Optional[asyncio.Task] = None
+
+async def flush_pending_submits():
+    async with _submit_flush_lock:
+        batch, _pending_submits[:] = _pending_submits[:], []
+        if not batch:
+            return
+
+        failed: Dict[int, Exception] = {}
+        try:
+            await contacts_collection.bulk_write([op for op, _ in batch], ordered=False)
+        except BulkWriteError as e:
+            failed = {err["index"]: e for err in e.details.get("writeErrors", [])}
+        except Exception as e:
+            failed = {i: e for i in range(len(batch))}
+
+        if len(failed) < len(batch):
+            await mark_data_changed()
+
+        for i, (_, future) in enumerate(batch):
+            if future.done():
+                continue
+            if i in failed:
+                future.set_exception(failed[i])
+            else:
+                future.set_result(None)
+
+async def submit_flush_loop():
+    while True:
+        try:
+            await asyncio.wait_for(_submit_batch_full.wait(), SUBMIT_FLUSH_INTERVAL)
+        except asyncio.TimeoutError:
+            pass
+        _submit_batch_full.clear()
+        try:
+            await flush_pending_submits()
+        except Exception as e:
+            contacts_logger.error("Error flushing contacts: %s", e)
+
+@app.on_event("startup")
+async def start_submit_batching():
+    global _submit_flush_task
+    if SUBMIT_BATCHING:
+        _submit_flush_task = asyncio.create_task(submit_flush_loop())
+
+@app.on_event("shutdown")
+async def stop_submit_batching():
+    if _submit_flush_task:
+        _submit_flush_task.cancel()
+        await flush_pending_submits()
+
+@api.post("/submit")
 async def submit_contact(
     company_name: str = Form(...),
     name: str = Form(...),
@@ -138,101 +481,216 @@ async def submit_contact(
             "call_date": call_date_parsed,
             "lead_entry_date": lead_entry_date_parsed,
             "comments": comments.strip() if comments else None,
-            "disposition": disposition,
-
-            "created_at": datetime.utcnow()
+            "disposition": disposition
         }
+        contact["search_tokens"] = build_search_tokens(contact)
+        contact["phone_digits"] = build_phone_digits(contact)
+
+        # created_at is still needed for sorting/filtering/pagination, but is
+        # stamped by the server ($currentDate) so app hosts' clocks don't matter
+        insert_op = UpdateOne(
+            {"_id": ObjectId()},
+            {"$setOnInsert": contact, "$currentDate": {"created_at": True}},
+            upsert=True
+        )
 
-        await contacts_collection.insert_one(contact)
+        if SUBMIT_BATCHING:
+            saved = asyncio.get_running_loop().create_future()
+            _pending_submits.append((insert_op, saved))
+            if len(_pending_submits) >= SUBMIT_BATCH_MAX:
+                _submit_batch_full.set()
+            await saved
+        else:
+            await contacts_collection.bulk_write([insert_op])
+            await mark_data_changed()
         return {"status": "success", "message": "Contact saved successfully"}
 
     except Exception as e:
-        print("Error saving contact:", e)
+        contacts_logger.error("Error saving contact: %s", e)
         raise HTTPException(status_code=500, detail="Server error while saving contact")
 
 # ------------------ Get History (with filters & pagination) ------------------
-@app.get("/get_history")
-async def get_history(
-    page: int = Query(1, ge=1),
-    limit: int = Query(50, ge=1, le=200),
-    search: str = Query(""),
-    company: str = Query(""),
-    phone: str = Query(""),
-    disposition: str = Query(""),
-    call_start: str = Query(""),
-    call_end: str = Query(""),
-    lead_start: str = Query(""),
-    lead_end: str = Query(""),
-    start: str = Query(""),
-    end: str = Query("")
-):
-    query: Dict[str, Any] = {}
+def and_query(*clauses: Dict[str, Any]) -> Dict[str, Any]:
+    clauses = [c for c in clauses if c]
+    if len(clauses) == 1:
+        return clauses[0]
+    return {"$and": clauses} if clauses else {}
+
+async def count_contacts(query: Dict[str, Any]) -> int:
+    # Unfiltered: read the count from collection metadata instead of scanning
+    if not query:
+        return await contacts_collection.estimated_document_count()
+
+    # Keyed on the stored write counter so any submit/update/delete (from any
+    # app instance) invalidates cached counts
+    key = f"{await get_data_version()}:{query!r}"
+    now = time.monotonic()
+    cached = _count_cache.get(key)
+    if cached and cached[0] > now:
+        return cached[1]
 
-    # Global search
-    if search.strip():
-        query["$or"] = [
-            {"name": {"$regex": search, "$options": "i"}},
-            {"company_name": {"$regex": search, "$options": "i"}},
-            {"mobile": {"$regex": search}},
-            {"email": {"$regex": search, "$options": "i"}}
-        ]
+    total = await contacts_collection.count_documents(query)
+    for stale in [k for k, v in _count_cache.items() if v[0] <= now]:
+        del _count_cache[stale]
+    _count_cache[key] = (now + COUNT_CACHE_TTL, total)
+    return total
 
-    # Company filter
-    if company.strip():
-        query["company_name"] = {"$regex": company, "$options": "i"}
+@api.get("/get_history")
+async def get_history(filters: Annotated[HistoryFilters, Query()]):
+    query: Dict[str, Any] = {}
+    # Independent predicates are ANDed so each one must hold and can use its own index
+    and_clauses = []
+
+    # Global search (substring match; escaped so user input is matched literally)
+    if filters.search.strip():
+        search_pattern = re.escape(filters.search.strip())
+        and_clauses.append({"$or": [
+            {"name": {"$regex": search_pattern, "$options": "i"}},
+            {"company_name": {"$regex": search_pattern, "$options": "i"}},
+            {"mobile": {"$regex": search_pattern}},
+            {"email": {"$regex": search_pattern, "$options": "i"}}
+        ]})
+
+        # Trigram prefilter (indexed) narrows candidates before the regex
+        # re-verifies; contacts saved before search_tokens existed still match
+        if len(filters.search.strip()) >= 3:
+            and_clauses.append({"$or": [
+                {"search_tokens": {"$all": list(trigrams(filters.search.strip()))}},
+                {"search_tokens": {"$exists": False}}
+            ]})
 
-    # Phone filter
-    if phone.strip():
-        query["$or"] = query.get("$or", []) + [
-            {"mobile": {"$regex": phone}},
-            {"mobile2": {"$regex": phone}}
-        ]
+    # Company filter
+    if filters.company.strip():
+        query["company_name"] = {"$regex": re.escape(filters.company.strip()), "$options": "i"}
+
+    # Phone filter: digits-only substring match against the normalized
+    # phone_digits; contacts saved before it existed fall back to the raw fields
+    phone_digits = re.sub(r"\D", "", filters.phone)
+    if phone_digits:
+        raw_phone = re.escape(filters.phone.strip())
+        and_clauses.append({"$or": [
+            {"phone_digits": {"$regex": re.escape(phone_digits)}},
+            {"phone_digits": {"$exists": False}, "$or": [
+                {"mobile": {"$regex": raw_phone}},
+                {"mobile2": {"$regex": raw_phone}}
+            ]}
+        ]})
 
     # Disposition filter
-    if disposition.strip():
-        query["disposition"] = disposition
+    if filters.disposition.strip():
+        query["disposition"] = filters.disposition
 
     # Call date filter
-    if call_start and call_end:
-        query["call_date"] = {
-            "$gte": datetime.fromisoformat(call_start),
-            "$lte": datetime.fromisoformat(call_end)
-        }
+    if filters.call_start and filters.call_end:
+        query["call_date"] = {"$gte": filters.call_start, "$lte": filters.call_end}
 
     # Lead entry date filter
-    if lead_start and lead_end:
-        query["lead_entry_date"] = {
-            "$gte": datetime.fromisoformat(lead_start),
-            "$lte": datetime.fromisoformat(lead_end)
-        }
+    if filters.lead_start and filters.lead_end:
+        query["lead_entry_date"] = {"$gte": filters.lead_start, "$lte": filters.lead_end}
 
     # Created_at filter
-    if start and end:
-        query["created_at"] = {
-            "$gte": datetime.fromisoformat(start),
-            "$lte": datetime.combine(datetime.fromisoformat(end), datetime.max.time())
-        }
-
-    skip = (page - 1) * limit
-    cursor = contacts_collection.find(query).sort("created_at", -1).skip(skip).limit(limit)
-
-    history = []
-    async for doc in cursor:
+    if filters.start and filters.end:
+        query["created_at"] = {"$gte": filters.start, "$lte": filters.end}
+
+    if len(and_clauses) == 1:
+        query.update(and_clauses[0])
+    elif and_clauses:
+        query["$and"] = and_clauses
+
+    sort_order = [("created_at", -1), ("_id", -1)]
+
+    # Both paging modes use the same order: dated contacts first (created_at,
+    # _id descending), then contacts with a missing/non-date created_at by _id
+    # descending. Keyset pagination continues after the last document of the
+    # previous page (a cursor with a null created_at points into the undated
+    # tail); the skip path is kept for direct page jumps (legacy=true, or no
+    # cursor) and skips across the dated range, then into the tail.
+    use_keyset = not filters.legacy and (filters.after_created_at or filters.after_id)
+    dated: Dict[str, Any] = {"created_at": {"$type": "date"}}
+    undated: Dict[str, Any] = {"created_at": {"$not": {"$type": "date"}}}
+
+    async def fetch_page() -> list:
+        history = []
+        skip = 0 if use_keyset else (filters.page - 1) * filters.limit
+        in_tail = use_keyset and filters.after_id and not filters.after_created_at
+
+        if not in_tail:
+            dated_query = dated
+            if use_keyset:
+                cur_dt = filters.after_created_at
+                dated_query = {"created_at": {"$lt": cur_dt}}
+                if filters.after_id:
+                    dated_query = {"$or": [
+                        {"created_at": {"$lt": cur_dt}},
+                        {"created_at": cur_dt, "_id": {"$lt": ObjectId(filters.after_id)}}
+                    ]}
+
+            cursor = contacts_collection.find(
+                and_query(query, dated_query), HIDDEN_FIELDS
+            ).sort(sort_order).skip(skip).limit(filters.limit)
+            history = await cursor.batch_size(filters.limit).to_list(length=filters.limit)
+
+        remaining = filters.limit - len(history)
+        if remaining > 0:
+            tail_query = dict(undated)
+            tail_skip = 0
+            if in_tail:
+                tail_query["_id"] = {"$lt": ObjectId(filters.after_id)}
+            elif skip and not history:
+                # The whole page lies past the dated range
+                dated_count = await contacts_collection.count_documents(and_query(query, dated))
+                tail_skip = max(skip - dated_count, 0)
+
+            cursor = contacts_collection.find(
+                and_query(query, tail_query), HIDDEN_FIELDS
+            ).sort("_id", -1).skip(tail_skip).limit(remaining)
+            history += await cursor.batch_size(remaining).to_list(length=remaining)
+
+        return history
+
+    # The page is fetched in as few awaits as possible, with the first server
+    # batch sized to the page.
+    # skip_count trades the page count for speed (like Eve's
+    # OPTIMIZE_PAGINATION_FOR_SPEED): total/pages are None and the client
+    # relies on has_next instead. Otherwise the count runs concurrently with
+    # the page fetch.
+    if filters.skip_count:
+        history = await fetch_page()
+        total = None
+        pages = None
+    else:
+        history, total = await asyncio.gather(fetch_page(), count_contacts(query))
+        pages = (total + filters.limit - 1) // filters.limit
+
+    for doc in history:
         doc["_id"] = str(doc["_id"])
-        history.append(doc)
 
-    total = await contacts_collection.count_documents(query)
-    pages = (total + limit - 1) // limit
+    next_cursor = None
+    if len(history) == filters.limit:
+        last_created_at = history[-1].get("created_at")
+        next_cursor = {
+            "created_at": last_created_at.isoformat() if isinstance(last_created_at, datetime) else None,
+            "_id": history[-1]["_id"]
+        }
 
-    return {
+    # page/total say nothing about a cursor's position, so cursor pages (like
+    # skip_count) infer has_next from a full page
+    if filters.skip_count or filters.after_created_at or filters.after_id:
+        has_next = len(history) == filters.limit
+    else:
+        has_next = filters.page * filters.limit < total
+
+    return CRMJSONResponse({
         "history": history,
-        "page": page,
+        "page": filters.page,
         "pages": pages,
-        "total": total
-    }
+        "total": total,
+        "has_next": has_next,
+        "next_cursor": next_cursor
+    })
 
 # ------------------ Update Contact ------------------
-@app.patch("/update/{id}")
+@api.patch("/update/{id}")
 async def update_contact(id: str, data: dict = Body(...)):
     if not ObjectId.is_valid(id):
         raise HTTPException(400, detail="Invalid ID")
@@ -240,7 +698,20 @@ async def update_contact(id: str, data: dict = Body(...)):
     # Handle date fields safely
     for field in ["call_date", "lead_entry_date"]:
         if field in data and isinstance(data[field], str):
-            data[field] = datetime.fromisoformat(data[field])
+            try:
+                data[field] = datetime.fromisoformat(data[field])
+            except ValueError:
+                raise HTTPException(422, detail=f"Invalid date for {field}")
+
+    # Keep the search trigrams and phone digits in sync with their source fields
+    source_fields = SEARCH_FIELDS + PHONE_FIELDS
+    if any(field in data for field in source_fields):
+        existing = await contacts_collection.find_one(
+            {"_id": ObjectId(id)}, {field: 1 for field in source_fields}
+        ) or {}
+        merged = {**existing, **data}
+        data["search_tokens"] = build_search_tokens(merged)
+        data["phone_digits"] = build_phone_digits(merged)
 
     result = await contacts_collection.update_one(
         {"_id": ObjectId(id)},
@@ -249,91 +720,208 @@ async def update_contact(id: str, data: dict = Body(...)):
 
     if result.modified_count == 0:
         raise HTTPException(404, detail="Contact not found or no changes made")
+    await mark_data_changed()
 
     return {"status": "success", "message": "Contact updated"}
 
 # ------------------ Export to Excel ------------------
-@app.get("/export_excel")
-async def export_excel():
+EXPORT_COLUMNS = [
+    "_id", "company_name", "name", "designation", "mobile", "mobile2",
+    "landline", "email", "email2", "linkedin", "address", "existing_client",
+    "partner_name", "call_date", "lead_entry_date", "comments", "disposition"
+]
+
+def _identity(value: Any) -> Any:
+    return value
+
+# Cell converters keyed on exact type: one dict lookup per cell instead of an
+# isinstance chain. Unlisted types are written as-is.
+CELL_CONVERTERS = {
+    ObjectId: str,
+    datetime: lambda v: v.strftime("%Y-%m-%d %H:%M:%S"),
+    type(None): lambda v: "",
+    list: str,
+    dict: str
+}
+
+def write_export_rows(worksheet, row_idx: int, docs: list) -> int:
+    get_converter = CELL_CONVERTERS.get
+    for doc in docs:
+        row = []
+        for k in EXPORT_COLUMNS:
+            value = doc.get(k)
+            row.append(get_converter(type(value), _identity)(value))
+        worksheet.write_row(row_idx, 0, row)
+        row_idx += 1
+    return row_idx
+
+# App-owned directory, so cleanup never touches other files in the system temp dir
+EXPORT_DIR = os.path.join(tempfile.gettempdir(), "crm_exports")
+# Superseded exports are kept this long so in-flight downloads can finish
+EXPORT_RETENTION = 600
+EXPORT_BATCH_SIZE = 1000
+EXPORT_MEDIA_TYPE = "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+
+# Running/finished export builds keyed by job id (= cache key), so concurrent
+# requests for the same data share one build
+_export_jobs: Dict[str, asyncio.Task] = {}
+
+def export_path(job_id: str) -> str:
+    # Job ids are sha1 hex digests; anything else must not reach the filesystem
+    if len(job_id) != 40 or not all(c in "0123456789abcdef" for c in job_id):
+        raise HTTPException(404, "Export job not found")
+    return os.path.join(EXPORT_DIR, f"export_{job_id}.xlsx")
+
+async def export_cache_key() -> str:
+    # Unchanged as long as no contact was inserted, updated or deleted. The
+    # stored write counter covers updates; count and latest created_at also
+    # catch inserts/deletes made outside the app
+    latest, count, version = await asyncio.gather(
+        contacts_collection.find_one(
+            {"created_at": {"$type": "date"}}, {"created_at": 1}, sort=[("created_at", -1)]
+        ),
+        contacts_collection.estimated_document_count(),
+        get_data_version()
+    )
+    last_created_at = latest["created_at"].isoformat() if latest else ""
+    raw = f"{last_created_at}_{count}_{version}"
+    return hashlib.sha1(raw.encode()).hexdigest()
+
+async def write_export(path: str):
+    # constant_memory flushes each row to disk as it is written, so the
+    # export never holds the whole collection in memory
+    workbook = xlsxwriter.Workbook(path, {"constant_memory": True, "strings_to_urls": False})
+    worksheet = workbook.add_worksheet()
+    worksheet.write_row(0, 0, EXPORT_COLUMNS)
+    row_idx = 1
+
+    # Single pass: only exported fields leave the server, and rows with an
+    # invalid created_at get a null sort key so they sort after valid dates
+    cursor = contacts_collection.aggregate([
+        {"$project": {
+            **{k: 1 for k in EXPORT_COLUMNS},
+            "sort_key": {"$cond": [
+                {"$eq": [{"$type": "$created_at"}, "date"]}, "$created_at", None
+            ]}
+        }},
+        {"$sort": {"sort_key": -1}}
+    ], allowDiskUse=True, batchSize=EXPORT_BATCH_SIZE)
+
+    # Format and write rows a batch at a time in a worker thread so the
+    # per-cell Python work does not block the event loop
+    batch = []
+    async for doc in cursor:
+        batch.append(doc)
+        if len(batch) == EXPORT_BATCH_SIZE:
+            row_idx = await asyncio.to_thread(write_export_rows, worksheet, row_idx, batch)
+            batch = []
+    if batch:
+        await asyncio.to_thread(write_export_rows, worksheet, row_idx, batch)
+
+    await asyncio.to_thread(workbook.close)
+
+async def build_export(job_id: str):
+    file_path = export_path(job_id)
+    os.makedirs(EXPORT_DIR, exist_ok=True)
+    with tempfile.NamedTemporaryFile(delete=False, suffix=".xlsx", dir=EXPORT_DIR) as tmp:
+        tmp_path = tmp.name
+
+    # A failed (or cancelled) build must not leave its temp file behind;
+    # cleanup below only sees finished export_*.xlsx files
     try:
-        data = []
-
-        # Fetch only valid datetime rows first (sorted)
-        cursor_good = contacts_collection.find({
-            "created_at": {"$type": "date"}
-        }).sort("created_at", -1)
-
-        async for doc in cursor_good:
-            data.append(doc)
-
-        # Fetch invalid datetime rows (unsorted)
-        cursor_bad = contacts_collection.find({
-            "created_at": {"$not": {"$type": "date"}}
-        })
-
-        async for doc in cursor_bad:
-            data.append(doc)
-
-        # Sanitize documents
-        cleaned = []
-        for doc in data:
-            safe = {}
-            for key, value in doc.items():
-
-                if isinstance(value, ObjectId):
-                    safe[key] = str(value)
-
-                elif isinstance(value, datetime):
-                    safe[key] = value.strftime("%Y-%m-%d %H:%M:%S")
-
-                elif value is None:
-                    safe[key] = ""
-
-                elif isinstance(value, (list, dict)):
-                    safe[key] = str(value)
-
-                else:
-                    safe[key] = value
-
-            cleaned.append(safe)
-
-        df = pd.DataFrame(cleaned)
-        
-        # Remove created_at column if exists
-        if "created_at" in df.columns:
-            df = df.drop(columns=["created_at"])
+        await write_export(tmp_path)
+        os.replace(tmp_path, file_path)
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
 
-        with tempfile.NamedTemporaryFile(delete=False, suffix=".xlsx") as tmp:
-            
-            df.to_excel(tmp.name, index=False)
-            file_path = tmp.name
+    # Drop exports superseded by this one, once they are past the retention window
+    cutoff = os.path.getmtime(file_path) - EXPORT_RETENTION
+    for old_path in glob.glob(os.path.join(EXPORT_DIR, "export_*.xlsx")):
+        try:
+            if old_path != file_path and os.path.getmtime(old_path) < cutoff:
+                os.remove(old_path)
+        except OSError:
+            pass
+
+async def start_export_job() -> str:
+    job_id = await export_cache_key()
+    job = _export_jobs.get(job_id)
+    if os.path.exists(export_path(job_id)) or (job and not job.done()):
+        return job_id
+
+    # Only the latest job is worth tracking; older ids map to stale data
+    _export_jobs.clear()
+    _export_jobs[job_id] = asyncio.create_task(build_export(job_id))
+    return job_id
+
+def export_file_response(job_id: str) -> FileResponse:
+    return FileResponse(
+        path=export_path(job_id),
+        filename=f"Master_Export_{datetime.now().strftime('%Y%m%d_%H%M%S')}.xlsx",
+        media_type=EXPORT_MEDIA_TYPE
+    )
 
-        return FileResponse(
-            path=file_path,
-            filename=f"Master_Export_{datetime.now().strftime('%Y%m%d_%H%M%S')}.xlsx",
-            media_type="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
-        )
+@api.post("/export_excel/start")
+async def start_export_excel():
+    try:
+        job_id = await start_export_job()
+    except Exception as e:
+        print("EXPORT ERROR:", e)
+        raise HTTPException(500, "Excel export failed")
+    return {"job_id": job_id}
+
+@api.get("/export_excel/status/{job_id}")
+async def export_excel_status(job_id: str):
+    if os.path.exists(export_path(job_id)):
+        return {"state": "done", "url": f"/api/export_excel/download/{job_id}"}
+
+    job = _export_jobs.get(job_id)
+    if not job:
+        raise HTTPException(404, "Export job not found")
+    if not job.done():
+        return {"state": "running", "url": None}
+    if job.exception():
+        print("EXPORT ERROR:", job.exception())
+    return {"state": "failed", "url": None}
+
+@api.get("/export_excel/download/{job_id}")
+async def download_export_excel(job_id: str):
+    if not os.path.exists(export_path(job_id)):
+        raise HTTPException(404, "Export not found")
+    return export_file_response(job_id)
+
+@api.get("/export_excel")
+async def export_excel():
+    try:
+        job_id = await start_export_job()
+        job = _export_jobs.get(job_id)
+        if job and not os.path.exists(export_path(job_id)):
+            await asyncio.shield(job)
+        return export_file_response(job_id)
 
     except Exception as e:
         print("EXPORT ERROR:", e)
         raise HTTPException(500, "Excel export failed")
 
 
-@app.get("/get_contact/{contact_id}")
+@api.get("/get_contact/{contact_id}")
 async def get_contact(contact_id: str):
     if not ObjectId.is_valid(contact_id):
         raise HTTPException(400, "Invalid ID")
     
-    contact = await contacts_collection.find_one({"_id": ObjectId(contact_id)})
+    contact = await contacts_collection.find_one({"_id": ObjectId(contact_id)}, HIDDEN_FIELDS)
     if not contact:
         raise HTTPException(404, "Contact not found")
     
-    contact["_id"] = str(contact["_id"])
-    return contact
+    return CRMJSONResponse(contact)
 
 
 # Delete Contact Endpoint
-@app.delete("/delete/{contact_id}")
+@api.delete("/delete/{contact_id}")
 async def delete_contact(contact_id: str):
     try:
         obj_id = ObjectId(contact_id)
@@ -342,6 +930,7 @@ async def delete_contact(contact_id: str):
         result = await contacts_collection.delete_one({"_id": obj_id})
         
         if result.deleted_count == 1:
+            await mark_data_changed()
             return {
                 "status": "success",
                 "message": "Contact deleted successfully",
@@ -353,28 +942,30 @@ async def delete_contact(contact_id: str):
     except Exception as e:
         raise HTTPException(500, f"Error deleting contact: {str(e)}")
 
+app.include_router(api)
+
 # ================================
 # Serve Static Files (HTML + assets)
 # MUST BE AT THE VERY END
+# In production set SERVE_FRONTEND=false and let nginx serve frontend/
+# (see nginx.conf); this keeps the event loop free for API requests.
 # ================================
 
-from fastapi.responses import FileResponse
-import os
-
-@app.get("/")
-async def serve_login():
-    file_path = os.path.join("frontend", "login.html")
-    if not os.path.exists(file_path):
-        raise HTTPException(404, f"File not found: {file_path}")
-    return FileResponse(file_path)
+if os.getenv("SERVE_FRONTEND", "true").lower() == "true":
 
-@app.get("/dashboard")
-async def serve_dashboard():
-    file_path = os.path.join("frontend", "index.html")
-    if not os.path.exists(file_path):
-        raise HTTPException(404, f"File not found: {file_path}")
-    return FileResponse(file_path)
+    @app.get("/")
+    async def serve_login():
+        file_path = os.path.join("frontend", "login.html")
+        if not os.path.exists(file_path):
+            raise HTTPException(404, f"File not found: {file_path}")
+        return FileResponse(file_path)
 
-# Mount static files BEFORE catch-all routes
-app.mount("/", StaticFiles(directory="frontend", html=True), name="frontend")
+    @app.get("/dashboard")
+    async def serve_dashboard():
+        file_path = os.path.join("frontend", "index.html")
+        if not os.path.exists(file_path):
+            raise HTTPException(404, f"File not found: {file_path}")
+        return FileResponse(file_path)
 
+    # Mount static files BEFORE catch-all routes
+    app.mount("/", StaticFiles(directory="frontend", html=True), name="frontend")